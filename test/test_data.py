@@ -0,0 +1,16 @@
+from ..utils.data import get_postcode, postcode_to_state
+import numpy as np
+import pytest
+
+def test_get_postcode_read_only():
+    postcodes = get_postcode()
+    with pytest.raises(ValueError):
+        postcodes['NSW'][0] = -1
+    with pytest.raises(TypeError):
+        postcodes['NSW'] = np.array([])
+    assert get_postcode()['NSW'][0] == 1000
+
+
+def test_postcode_to_state():
+    states = postcode_to_state([2000, '2600', 800, 9999, 6798, 10000, -1, 'abc', None, 2000.5])
+    assert list(states) == ['NSW', 'ACT', 'NT', 'QLD', '', '', '', '', '', '']
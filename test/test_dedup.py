@@ -1,5 +1,8 @@
-from ..utils.deduplicate import Duplication
+from ..utils.deduplicate import Duplication, prepare_pcr
+from jellyfish import jaro_winkler_similarity
+import numpy as np
 import pandas as pd
+import threading
 
 def test_removed_one():
     df = pd.DataFrame({'given_name': ['josjua', 'joshua', 'vanessa', 'thierry'],
@@ -21,3 +24,75 @@ def test_no_removed():
     dupli.detect_duplicates(df)
     assert dupli.removed == 0
 
+
+def test_positive_reference():
+    df = pd.DataFrame({'patient_id': [1, 2, 3],
+                       'given_name': ['joshua', 'alice', 'joshua'],
+                       'surname': ['white', 'white', 'white'],
+                       'state': ['nsw', 'nsw', 'qld']})
+    df_pcr = pd.DataFrame({'patient_id': [2, 3], 'pcr': ['P', 'N']})
+
+    dupli = Duplication(variable_testing=['surname'], var_similarity=['given_name'],
+                        var_threshold=['given_name', 'state'], df_pcr=df_pcr, threshold=0.5)
+    df = dupli.detect_duplicates(df)
+    assert list(df.patient_id) == [2, 3]
+
+
+def test_non_ascii_similarity():
+    df = pd.DataFrame({'surname': ['white'] * 6,
+                       'given_name': ['élodie', 'élodïe', 'élise', 'hélène', 'éa', 'éé'],
+                       'state': ['nsw', 'nsw', 'qld', 'nsw', 'wa', 'wa']})
+    kwargs = dict(variable_testing=['surname'], var_similarity=['given_name'],
+                  var_threshold=['given_name'], threshold=1.0)
+
+    expected = Duplication(metric=jaro_winkler_similarity, **kwargs).detect_duplicates(df)
+    df = Duplication(**kwargs).detect_duplicates(df)
+    assert list(df.index) == list(expected.index) == [0, 3, 4, 5]
+
+
+def test_custom_metric_single_thread():
+    threads = set()
+
+    def metric(a, b):
+        threads.add(threading.get_ident())
+        return jaro_winkler_similarity(a, b)
+
+    df = pd.DataFrame({'surname': ['white', 'white', 'laing', 'laing', 'lang', 'lang'],
+                       'given_name': ['joshua', 'joshau', 'ky', 'ky', 'alice', 'alyce']})
+    Duplication(variable_testing=['surname'], var_similarity=['given_name'],
+                metric=metric, n_jobs=4).detect_duplicates(df)
+    assert threads == {threading.get_ident()}
+
+
+def test_metric_set_after_construction():
+    df = pd.DataFrame({'surname': ['white', 'white'],
+                       'given_name': ['joshua', 'kylie']})
+    dupli = Duplication(variable_testing=['surname'], var_similarity=['given_name'],
+                        var_threshold=['given_name'])
+    dupli.metric = lambda a, b: 1.0
+    df = dupli.detect_duplicates(df)
+    assert list(df.index) == [0]
+
+
+def test_missing_similarity_value():
+    df = pd.DataFrame({'surname': ['white', 'white'],
+                       'given_name': ['joshua', np.nan],
+                       'state': ['zzz', 'joshua']})
+    dupli = Duplication(variable_testing=['surname'], var_similarity=['given_name'],
+                        var_threshold=['given_name'], threshold=1.0)
+    df = dupli.detect_duplicates(df)
+    assert list(df.index) == [0, 1]
+
+
+def test_prepare_pcr():
+    df_pcr = pd.DataFrame({'patient_id': [1, 2, 2, 3, 3, 4],
+                           'pcr': ['N', 'N', 'P', 'N', 'N', 'P']})
+    not_dupli_pcr = df_pcr[df_pcr.duplicated(subset=['patient_id', 'pcr'], keep='first')]
+    positive_pi = pd.concat([df_pcr.loc[[2]],
+                             pd.DataFrame({'patient_id': [5], 'pcr': ['P']}, index=[10])])
+
+    # row 2 is in both retained tables and is only kept once
+    df = prepare_pcr(df_pcr, positive_pi, pd.concat([not_dupli_pcr, df_pcr.loc[[2]]]))
+    assert list(df.index) == [0, 2, 4, 5, 10]
+    assert list(df.patient_id) == [1, 2, 3, 4, 5]
+    assert list(df.pcr) == ['N', 'P', 'N', 'P', 'P']
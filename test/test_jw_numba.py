@@ -0,0 +1,43 @@
+from ..utils.jw_numba import encode_ascii, jw_batch
+from jellyfish import jaro_winkler_similarity
+import numpy as np
+import pytest
+import random
+
+def jw_numba(values, ref):
+    others, other_lens = encode_ascii(values)
+    ref_enc, ref_len = encode_ascii([ref])
+    out = np.empty(len(values))
+    jw_batch(ref_enc[0], ref_len[0], others, other_lens, out)
+    return out
+
+
+def test_encode_ascii():
+    encoded, lengths = encode_ascii(['ab', '', 'abcd'])
+    assert encoded.shape == (3, 4)
+    assert list(encoded[0]) == [97, 98, 0, 0]
+    assert list(lengths) == [2, 0, 4]
+    with pytest.raises(UnicodeEncodeError):
+        encode_ascii(['élodie'])
+
+
+@pytest.mark.parametrize('ref, values', [
+    ('', ['', 'a', 'joshua']),                       # empty strings
+    ('a', ['a', 'b', '', 'ab', 'ba']),               # length 1
+    ('martha', ['marhta', 'mrtaha', 'amrtha']),      # transpositions
+    ('abcdefgh', ['abcdefgx', 'abcdxfgh', 'abcxefgh', 'xbcdefgh']),  # prefix cap of 4
+    ('abc', ['abd', 'abcd', 'ab']),                  # no prefix bonus under 4 characters
+    ('12 rue', ['12 rua', '1 rue', '12 ru']),         # no prefix bonus on digits
+])
+def test_jw_batch_cases(ref, values):
+    expected = [jaro_winkler_similarity(val, ref) for val in values]
+    assert list(jw_numba(values, ref)) == expected
+
+
+def test_jw_batch_random():
+    random.seed(0)
+    values = [''.join(random.choice('abcde12') for _ in range(random.randint(0, 10)))
+              for _ in range(500)]
+    for ref in values[:50]:
+        expected = [jaro_winkler_similarity(val, ref) for val in values]
+        assert list(jw_numba(values, ref)) == expected
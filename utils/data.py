@@ -1,51 +1,91 @@
 import numpy as np
+import pandas as pd
+from functools import lru_cache
+from types import MappingProxyType
 from genderize import Genderize, GenderizeException
 import json
 import os
 import geopandas as gpd
 
-def get_postcode():
+_RAW_RANGES = {"NSW": [(1000, 1999), (2000, 2599), (2619, 2899), (2921, 2999)],
+               "ACT": [(200, 299), (2600, 2618), (2900, 2920)],
+               "VIC": [(8000, 8999), (3000, 3999)],
+               "QLD": [(4000, 4999), (9000, 9999)],
+               "SA": [(5000, 5999)],
+               "WA": [(6000, 6797), (6800, 6999)],
+               "TAS": [(7000, 7999)],
+               "NT": [(800, 999)]}
+
+
+_CODES = np.array(['', 'NSW', 'ACT', 'VIC', 'QLD', 'SA', 'WA', 'TAS', 'NT'])
+
+
+def _build_state_table():
     """
-    Return a dictionnary States as keys and postcodes as values.
+    Return a lookup table where the position is the postcode and the value 
+    the index of the state in _CODES (0 if the postcode is not attributed).
     """
-    return {"NSW": np.concatenate([np.arange(1000, 1999+1),
-                                   np.arange(2000, 2599+1),
-                                   np.arange(2619, 2899+1),
-                                   np.arange(2921, 2999+1)]),
+    state_table = np.zeros(10000, dtype=np.uint8)
+    for index, code in enumerate(_CODES):
+        for lo, hi in _RAW_RANGES.get(code, []):
+            state_table[lo:hi+1] = index
+    return state_table
+
 
-            "ACT": np.concatenate([np.arange(200, 299+1),
-                                   np.arange(2600, 2618+1),
-                                   np.arange(2900, 2920+1)]),
+_STATE_TABLE = _build_state_table()
 
-            "VIC": np.concatenate([np.arange(8000, 8999+1),
-                                   np.arange(3000, 3999+1)]),
 
-            "QLD": np.concatenate([np.arange(4000, 4999+1),
-                                   np.arange(9000, 9999+1)]),
+@lru_cache(maxsize=1)
+def get_postcode():
+    """
+    Return a read-only dictionnary States as keys and postcodes as values.
+    """
+    postcodes = {}
+    for code, ranges in _RAW_RANGES.items():
+        postcodes[code] = np.concatenate([np.arange(lo, hi+1) for lo, hi in ranges])
+        postcodes[code].setflags(write=False)
+    return MappingProxyType(postcodes)
+
 
-            "SA": np.arange(5000, 5999+1),
+def postcode_to_state(postcode):
+    """
+    Return the state code for each postcode of an array. 
+    Postcodes not attributed to a state, or that are not numbers, 
+    return an empty string.
+    """
+    postcode = pd.to_numeric(pd.Series(postcode), errors="coerce")
+    postcode = postcode.fillna(-1).to_numpy(dtype=float)
+    valid = (postcode >= 0) & (postcode < len(_STATE_TABLE)) & (postcode == np.floor(postcode))
+    state = _STATE_TABLE[np.where(valid, postcode, 0).astype(np.int64)]
+    return _CODES[np.where(valid, state, 0)]
 
-            "WA": np.concatenate([np.arange(6000, 6797+1),
-                                  np.arange(6800, 6999+1)]),
 
-            "TAS": np.arange(7000, 7999+1),
+STATES = MappingProxyType({"South Australia":"SA",
+                           "Western Australia": "WA",
+                           "New South Wales": "NSW",
+                           "Queensland": "QLD",
+                           "Tasmania": "TAS",
+                           "Victoria": "VIC",
+                           "Northern Territory":"NT",
+                           "Australian Capital Territory":"ACT"})
 
-            "NT": np.arange(800, 999+1)}
+STATE_CODES = MappingProxyType({code: state for state, code in STATES.items()})
 
 
 def get_states():
     """
-    Return a dictionnary where states of Australia are keys 
+    Return a read-only dictionnary where states of Australia are keys 
     and values are the code for each state.
     """
-    return {"South Australia":"SA",
-            "Western Australia": "WA",
-            "New South Wales": "NSW",
-            "Queensland": "QLD",
-            "Tasmania": "TAS",
-            "Victoria": "VIC",
-            "Northern Territory":"NT",
-            "Australian Capital Territory":"ACT"}
+    return STATES
+
+
+def get_state_codes():
+    """
+    Return a read-only dictionnary where the codes of each state of 
+    Australia are keys and values are the states.
+    """
+    return STATE_CODES
 
 
 
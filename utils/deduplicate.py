@@ -1,6 +1,11 @@
+from functools import lru_cache
+from joblib import Parallel, delayed
 from jellyfish import jaro_winkler_similarity
+from rapidfuzz import process
+from rapidfuzz.distance import Jaro
 import pandas as pd
 import numpy as np
+from .jw_numba import encode_ascii, jw_batch
 
 
 class Duplication:
@@ -16,10 +21,12 @@ class Duplication:
     confidence : retained threshold for the similarity between two values
     threshold : pourcentage of identical values considered to assess if an observation is duplicate
     metric : function to compare string (default is Jaro Winkler similarity)
+    n_jobs : number of threads used to process the clusters (-1 uses all processors). 
+             A custom metric is always run in a single thread.
     """
     
     def __init__(self, variable_testing=None, var_threshold=None, df_pcr=None, var_similarity=None, 
-                confidence=0.8, threshold=0.7, metric=None, remove_dupli_pi=False):
+                confidence=0.8, threshold=0.7, metric=None, remove_dupli_pi=False, n_jobs=-1):
 
         self.var_threshold = var_threshold
         self.var_similarity = var_similarity
@@ -28,6 +35,7 @@ class Duplication:
         self.variable_testing = variable_testing
         self.df_pcr = df_pcr
         self.remove_dupli_pi = remove_dupli_pi  
+        self.n_jobs = n_jobs
         
         if metric is None:
             self.metric = jaro_winkler_similarity
@@ -45,23 +53,54 @@ class Duplication:
         df_patient : dataframe without duplicates 
         """
 
-        df_patient_init = df_patient.copy()
+        n_init = len(df_patient)
 
         if self.variable_testing is None:
             self.variable_testing = df_patient.columns
-        
-        
-        # get all unique values for a given testing variable
-        for variable in self.variable_testing:
-            all_unique = df_patient[variable][df_patient[variable].duplicated(
-                False)].unique()
-
-            # get index of duplicates found
-            list_dupli = self.__get_indice_duplicated__(
-                df_patient, self.df_pcr, variable, all_unique)
-            
-            # remove duplicate values from an input dataframe 
-            df_patient = self.__df_deduplicate__(df_patient, list_dupli, variable)
+
+        # resolve once the variables used for the similarity and the threshold
+        columns = df_patient.columns
+        var_similarity = columns if self.var_similarity is None else self.var_similarity
+        var_threshold = columns if self.var_threshold is None else self.var_threshold
+
+        # only the threshold variables are compared : with the similarity if 
+        # they are in var_similarity, else on equality
+        self._thr_positions = np.array([columns.get_loc(var) for var in var_threshold])
+        compared = np.unique(self._thr_positions)
+        sim_set = frozenset(var_similarity)
+        is_sim = np.array([columns[col] in sim_set for col in compared], dtype=bool)
+        self._sim_positions = compared[is_sim]
+        self._nonsim_positions = compared[~is_sim]
+
+        # the built-in Jaro Winkler is computed in batch, any other metric 
+        # (possibly set after the construction) is called for each pair
+        self._custom_metric = self.metric is not jaro_winkler_similarity
+
+        # the same pair of values is often compared in several clusters : 
+        # keep the results of a custom metric during the detection
+        if self._custom_metric:
+            self._cached_metric = lru_cache(maxsize=1 << 20)(self.metric)
+
+        # patients tested and patients tested positive in the table pcr
+        if self.df_pcr is not None:
+            self._tested_pids = frozenset(self.df_pcr.patient_id)
+            self._positive_pids = frozenset(
+                self.df_pcr.loc[self.df_pcr.pcr == "P", "patient_id"])
+
+        try:
+            for variable in self.variable_testing:
+
+                # get index of duplicates found
+                list_dupli = self.__get_indice_duplicated__(
+                    df_patient, self.df_pcr, variable)
+                
+                # remove duplicate values from an input dataframe 
+                df_patient = self.__df_deduplicate__(df_patient, list_dupli, variable)
+        finally:
+            # release the arrays of the last testing variable and the cached results
+            self._arrays = None
+            if self._custom_metric:
+                self._cached_metric.cache_clear()
 
         # remove duplicates id
         if self.remove_dupli_pi:
@@ -72,12 +111,11 @@ class Duplication:
                 print('No patient id column')
 
         # attribute that shows the number of data removed
-        self.removed = round(
-            1 - (df_patient.shape[0] / df_patient_init.shape[0]), 2)
+        self.removed = round(1 - (df_patient.shape[0] / n_init), 2)
 
         return df_patient
 
-    def __get_indice_duplicated__(self, df_patient, df_pcr, variable, all_dupli):
+    def __get_indice_duplicated__(self, df_patient, df_pcr, variable):
         """
         Find index of duplicate values.
 
@@ -86,165 +124,238 @@ class Duplication:
         df_patient : dataframe, dataset patient
         df_pcr : dataframe, dataset pcr
         variable : str, reference variable to retain duplicates
-        all_dupli : list, all uniques values 
         """
-        indice_duplicates = []
-
-        for dupli in all_dupli:
-
-            # create a cluster of duplicates observations according to 
-            # the test variable and return the index of the reference 
-            # observation used for the comparison
-            clus, ref = self.__make_cluster__(
-                variable, df_patient, df_pcr, dupli)
-
-            # compute for each observation of the cluster the pourcentage of matching 
-            # with the reference observation
-            
-            if self.var_similarity is None:
-                self.var_similarity = df_patient.columns
+        # only the observations sharing their value with another one can be 
+        # duplicates : the arrays are built for these observations only
+        dup_pos = np.flatnonzero(df_patient[variable].duplicated(keep=False).to_numpy())
+        if not len(dup_pos):
+            return []
+        df_dupli = df_patient.iloc[dup_pos]
+        self._arrays = self.__store_arrays__(df_dupli, df_pcr)
+
+        # create a cluster of duplicates observations (given by their positions 
+        # in df_dupli) for each duplicated value of the test variable. Clusters 
+        # are independent and processed in parallel threads.
+        groups = df_dupli.groupby(variable, sort=False).indices
+        clusters = [positions for positions in groups.values() if len(positions) > 1]
+
+        # a custom metric holds the GIL and may not be thread-safe
+        n_jobs = 1 if self._custom_metric else self.n_jobs
+        results = Parallel(n_jobs=n_jobs, prefer="threads")(
+            delayed(self.__process_cluster__)(clus, df_pcr) for clus in clusters)
+
+        if not results:
+            return []
+        return list(df_dupli.index[np.concatenate(results)])
+
+    def __store_arrays__(self, df_dupli, df_pcr):
+        """
+        Return the compared variables as arrays shared by all the clusters, 
+        indexed by the position of the observations in df_dupli.
+        Each variable compared with the similarity is stored as the codes of 
+        its values and the fixed width array of its unique values (encoded 
+        in bytes if they are ASCII), so that strings are not copied for 
+        each cluster.
+        """
+        arrays = {"n_columns": df_dupli.shape[1],
+                  "eq_values": df_dupli.iloc[:, self._nonsim_positions].to_numpy(),
+                  "sim": {}}
+
+        for col in self._sim_positions:
+            values = df_dupli.iloc[:, col].to_numpy()
+            if self._custom_metric:
+                arrays["sim"][col] = {"values": values}
+            else:
+                # missing values are compared as the string 'nan'
+                codes, uniques = pd.factorize(values.astype(str))
+                uniques = np.asarray(uniques, dtype=str)
+                try:
+                    encoded, _ = encode_ascii(uniques)
+                except UnicodeEncodeError:
+                    encoded = None
+                arrays["sim"][col] = {"codes": codes,
+                                      "uniques": uniques,
+                                      "lens": np.char.str_len(uniques),
+                                      "firsts": uniques.astype("U1"),
+                                      "encoded": encoded}
+
+        if df_pcr is not None:
+            pids = df_dupli["patient_id"]
+            arrays["is_tested"] = pids.isin(self._tested_pids).to_numpy()
+            arrays["is_positive"] = pids.isin(self._positive_pids).to_numpy()
+
+        return arrays
+
+    def __process_cluster__(self, clus, df_pcr):
+        """
+        Return the positions of the duplicate observations of a cluster.
 
-            match = self.__matching_cluster__(clus, ref, self.var_similarity)
+        Parameters
+        ----------
+        clus : array, positions of the cluster observations in df_dupli
+        df_pcr : dataframe, dataset pcr
+        """
+        # return the position of the reference observation used for the comparison
+        ref = self.__choose_ref__(clus, df_pcr)
 
-            # set a threshold to qualify an observation as duplicate and 
-            # retain those that do not exceed this threshold
-            
-            if self.var_threshold is None:
-                self.var_threshold = df_patient.columns
+        # compute for each observation of the cluster the pourcentage of matching 
+        # with the reference observation
+        match = self.__matching_cluster__(clus, ref, self._sim_positions,
+                                          self._nonsim_positions)
 
-            cm = self.__calculate_matching__(match, self.var_threshold)
-            duplicate = cm >= self.threshold
-            
-            if any(duplicate):
-                indice_duplicates.extend(duplicate.index[duplicate])
+        # set a threshold to qualify an observation as duplicate and 
+        # retain those that do not exceed this threshold
+        cm = self.__calculate_matching__(match, self._thr_positions)
+        duplicate = cm >= self.threshold
 
-        return indice_duplicates
+        return np.delete(clus, ref)[duplicate]
 
-    def __make_cluster__(self, variable, df_patient, df_pcr, dupli):
+    def __choose_ref__(self, cluster, df_pcr):
         """
-        Create a duplicate observation cluster according to a test variable.
+        Choose the reference observation of a duplicate observation cluster.
 
         Parameters 
         ----------
-        df_patient : dataframe, dataset patient
+        cluster : array, positions of the cluster observations in df_dupli
         df_pcr : dataframe, dataset pcr
-        variable : str, reference variable to retain duplicates
-        dupli : str or float, one unique value from the list_dupli
 
         Return 
         ------
-        cluster : dataframe of duplicates
-        ref_index : int, index of the reference observation
+        ref_pos : int, position of the reference observation in the cluster
         """
 
-        cluster = df_patient[df_patient[variable] == dupli]
-
         # Find all observations of the cluster that have been tested in the table pcr
         if df_pcr is None : 
-            ref_index = cluster.index[0]
-            return cluster, ref_index
+            return 0
         
-        is_tested = cluster.patient_id.isin(df_pcr.patient_id)
+        is_tested = self._arrays["is_tested"][cluster]
+        is_positive = self._arrays["is_positive"][cluster]
         
-        # - if one observation is tested : use it as a baseline observation, else
-        # choose the first observation
+        # - if one observation is tested : use it as a baseline observation
         # - if two or more observations are tested : find out if one of the
-        # patient is postive. Retain the index of the first positive patient, 
-        # if there is one. Else, retains the first observation index.
+        # patient is postive. Retain the first positive patient, if there 
+        # is one. Else, retains the first tested observation.
+        # - if no observation is tested : retains the first observation.
         
-        if any(is_tested):
-            index_tested = is_tested.index[is_tested]
-            h_many_id = len(index_tested)
+        pos_positive = np.flatnonzero(is_tested & is_positive)
+        pos_tested = np.flatnonzero(is_tested)
 
-            if h_many_id == 1:
-                ref_index = index_tested[0]
-            else:
-                is_positive = self.__find_positive__(index_tested, df_pcr, df_patient)
-                if any(is_positive):
-                    index_positive = self.__get_positive__(df_patient, df_pcr, is_positive)
-                    ref_index = index_positive[np.isin(index_positive, index_tested)][0]
-                else:
-                    ref_index = index_tested[0]
+        if len(pos_positive):
+            ref_pos = pos_positive[0]
+        elif len(pos_tested):
+            ref_pos = pos_tested[0]
         else:
-            ref_index = is_tested.index[0]
+            ref_pos = 0
 
-        return cluster, ref_index
+        return ref_pos
 
-    def __matching_cluster__(self, cluster, ref_index, var_similarity):
+    def __matching_cluster__(self, cluster, ref_pos, sim_positions, nonsim_positions):
         """
         Compute for each observation of the cluster the matching pourcentage 
         with the reference observation.
 
         Parameters
         ----------
-        cluster : dataframe of duplicates
-        ref_index : int, index of the reference observation
-        var_similarity : float, threshold to qualify an observation as duplicate
+        cluster : array, positions of the cluster observations in df_dupli
+        ref_pos : int, position of the reference observation in the cluster
+        sim_positions : array, positions of the columns compared with the similarity
+        nonsim_positions : array, positions of the columns compared on equality
 
         Return
         ------
-        dataframe : return a boolean dataframe
+        out : boolean array, one row for each observation of the cluster 
+        except the reference, one column for each variable (only the 
+        compared variables are filled)
         """
-        matching = list()
-
-        for line in cluster.index:
-            if not(line == ref_index):
-
-                var_identical = {}
-                
-                # For each column of each row (excluding the reference 
-                # index) compute the similarity between two strings (with an 
-                # algorithm) for the chosen variables. 
-                # Else, only compare these values.
-
-                for var in cluster.columns:
-                    var_identical["index"] = line
-
-                    if var in var_similarity:
-
-                        var_identical[var] = self.metric(cluster.loc[line, var],
-                                                    cluster.loc[ref_index, var]) > self.confidence
-
-                    else:
-                        var_identical[var] = cluster.loc[line, var] == cluster.loc[
-                        ref_index, var]
+        ref = cluster[ref_pos]
+        others = np.delete(cluster, ref_pos)
+
+        out = np.zeros((len(others), self._arrays["n_columns"]), dtype=bool)
+
+        # For the chosen variables, compute the similarity between two strings 
+        # (with an algorithm) for each row (excluding the reference row).
+        # Else, only compare these values.
+        for col in sim_positions:
+            if self._custom_metric:
+                values = self._arrays["sim"][col]["values"]
+                out[:, col] = [self._cached_metric(val, values[ref]) > self.confidence
+                               for val in values[others]]
+            else:
+                out[:, col] = self.__similarity__(self._arrays["sim"][col], others, ref)
 
-                matching.append(var_identical)
+        out[:, nonsim_positions] = self._arrays["eq_values"][others] == self._arrays["eq_values"][ref]
 
-        dataframe = pd.DataFrame(matching).set_index('index')
-        dataframe.index.name = None
-        return dataframe
+        return out
 
-    def __calculate_matching__(self, match, var_threshold):
+    def __similarity__(self, column, others, ref):
         """
-        Calcule the pourcentage of matching for each observation in cluster 
-        with chosen variables.
+        Compare the values of a column for some observations with the value 
+        of the reference observation using the Jaro Winkler similarity. 
+        Return a boolean array.
+        Each distinct value is only compared once, and values that can not 
+        reach the confidence are not compared.
         """
-        return match[var_threshold].sum(axis=1) / len(var_threshold)
-
-    def __df_deduplicate__(self, df_patient, indice_duplicates, variable):
+        codes, inverse = np.unique(column["codes"][others], return_inverse=True)
+        ref_code = column["codes"][ref]
+
+        # upper bound of the similarity from the lengths and the first character :
+        # jaro <= (2 + min_len/max_len) / 3, and without a common first character 
+        # there is no prefix bonus (else the bonus is at most 0.4 * (1 - jaro))
+        lens = column["lens"][codes]
+        ref_len = column["lens"][ref_code]
+        jaro_max = (2 + np.minimum(lens, ref_len) / np.maximum(np.maximum(lens, ref_len), 1)) / 3
+        same_first = column["firsts"][codes] == column["firsts"][ref_code]
+        sim_max = np.where(same_first, 0.4 + 0.6 * jaro_max, jaro_max)
+        candidate = (sim_max + 1e-9 > self.confidence) & (lens > 0) & (ref_len > 0)
+
+        is_similar = np.zeros(len(codes), dtype=bool)
+        if candidate.any():
+            sims = self.__jaro_winkler__(column, codes[candidate], ref_code)
+            is_similar[candidate] = sims > self.confidence
+
+        return is_similar[inverse.ravel()]
+
+    def __jaro_winkler__(self, column, codes, ref_code):
         """
-        Remove duplicates from a pandas dataframe with the indices duplicated.
+        Jaro Winkler similarity between the unique values of a column (given 
+        by their codes) and the reference value.
+        ASCII strings are compared with a numba kernel, other strings 
+        with the Jaro similarity of RapidFuzz and the prefix bonus of jellyfish.
         """
-        list_d = np.array(indice_duplicates)
-        print(f"{variable} : {len(indice_duplicates)} lines removed")
-        return df_patient.loc[np.setdiff1d(df_patient.index, list_d)]
-
-    def __find_positive__(self, index_tested, df_pcr, df_patient):
+        encoded, lens = column["encoded"], column["lens"]
+
+        if encoded is None:
+            values = column["uniques"][codes]
+            ref_val = column["uniques"][ref_code]
+            sims = process.cdist(values, [ref_val], scorer=Jaro.normalized_similarity,
+                                 dtype=np.float64).ravel()
+
+            # bonus for the common prefix (up to 4 characters, digits excluded) 
+            # when both strings have more than 3 characters
+            heads = values.astype("U4").view(np.uint32).reshape(len(values), 4)
+            ref_head = np.array([ref_val], dtype="U4").view(np.uint32)
+            same = (heads == ref_head) & ((heads < 48) | (heads > 57))
+            prefix = np.cumprod(same, axis=1).sum(axis=1)
+            boost = (sims > 0.7) & (lens[codes] > 3) & (lens[ref_code] > 3)
+            return np.where(boost, sims + prefix * 0.1 * (1.0 - sims), sims)
+
+        sims = np.empty(len(codes))
+        jw_batch(encoded[ref_code], lens[ref_code], encoded[codes], lens[codes], sims)
+        return sims
+
+    def __calculate_matching__(self, match, thr_positions):
         """
-        Find if a patient is positive from a pcr dataframe.
+        Calcule the pourcentage of matching for each observation in cluster 
+        with chosen variables (given by their positions).
         """
-        is_positive = df_pcr[df_pcr.patient_id.isin(
-            df_patient.loc[index_tested].patient_id)].pcr == "P"
-        return is_positive
+        return match[:, thr_positions].sum(axis=1) / len(thr_positions)
 
-    def __get_positive__(self, df_patient, df_pcr, is_positive):
+    def __df_deduplicate__(self, df_patient, indice_duplicates, variable):
         """
-        Retains the line of positive patient.
+        Remove duplicates from a pandas dataframe with the indices duplicated.
         """
-        return df_patient[
-        df_patient.patient_id.isin(
-            df_pcr.patient_id[is_positive.index[is_positive]])].index
+        print(f"{variable} : {len(indice_duplicates)} lines removed")
+        return df_patient.drop(index=pd.Index(indice_duplicates).unique(), errors='ignore')
 
 
 def prepare_patient(df_patient):
@@ -256,19 +367,23 @@ def prepare_patient(df_patient):
     df_patient = df_patient.fillna('')
     
     # born and age
-    df_patient["born_age"] = df_patient.apply(lambda x: str(
-    	x["date_of_birth"]).replace('.0', '').replace('nan','') + " " + str(
-    	x["age"]).replace('.0','').replace('nan',''), axis=1)
+    born = df_patient["date_of_birth"].astype(str).str.replace(
+        '.0', '', regex=False).str.replace('nan', '', regex=False)
+    age = df_patient["age"].astype(str).str.replace(
+        '.0', '', regex=False).str.replace('nan', '', regex=False)
+    df_patient["born_age"] = born.str.cat(age, sep=" ")
     
     # localisation (postcode, suburb and state)
-    df_patient.street_number = df_patient.street_number.replace(
-        {"": 0}).astype(int).astype(str).replace({"0": ""})
-    df_patient["localisation"] = df_patient.apply(lambda x : x["postcode"] + " " + 
-    	x["state"] + " " + x["suburb"], axis=1)
+    street_number = pd.to_numeric(df_patient["street_number"], errors="coerce")
+    df_patient["street_number"] = np.where(
+        street_number.isna() | (street_number == 0), "",
+        street_number.fillna(0).astype(np.int64).astype(str))
+    df_patient["localisation"] = df_patient["postcode"].str.cat(
+        [df_patient["state"], df_patient["suburb"]], sep=" ")
     
     # full address (number and adress)
-    df_patient["full_address"] = df_patient.apply(lambda x : x["street_number"] + " " 
-                                                  + x["address_1"], axis=1)
+    df_patient["full_address"] = df_patient["street_number"].str.cat(
+        df_patient["address_1"], sep=" ")
     # full name (surname and given name)
     df_patient["full_name"] = df_patient["surname"] + " " + df_patient["given_name"]
     
@@ -277,9 +392,15 @@ def prepare_patient(df_patient):
 
 def prepare_pcr(df_pcr, positive_pi, not_dupli_pcr):
     """
-    Deduplicate pcr table
+    Deduplicate pcr table : keep patients tested once, and the tests 
+    retained in positive_pi and not_dupli_pcr for patients tested several times.
     """
-    keep = pd.concat([positive_pi, not_dupli_pcr])
-    df_pcr = df_pcr.drop_duplicates(keep=False, subset=["patient_id"])
-    df_pcr = pd.concat([df_pcr, keep])
-    return df_pcr
+    keep_index = positive_pi.index.append(not_dupli_pcr.index)
+    is_unique = ~df_pcr.patient_id.duplicated(keep=False)
+    df_pcr_dedup = df_pcr[is_unique.to_numpy() | df_pcr.index.isin(keep_index)]
+
+    # retained tests that are not in the pcr table
+    extra = [keep[~keep.index.isin(df_pcr.index)] for keep in (positive_pi, not_dupli_pcr)]
+    if any(len(rows) for rows in extra):
+        df_pcr_dedup = pd.concat([df_pcr_dedup] + extra)
+    return df_pcr_dedup
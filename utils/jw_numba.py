@@ -0,0 +1,87 @@
+import numpy as np
+from numba import njit
+
+
+def encode_ascii(values):
+    """
+    Encode an array of ASCII strings into a (N, L) uint8 buffer padded with
+    null bytes, and return it with the length of each string.
+    Raise UnicodeEncodeError if a string is not ASCII.
+    """
+    values = np.asarray(values, dtype=str)
+    points = values.view(np.uint32).reshape(len(values), -1)
+    non_ascii = np.flatnonzero((points > 127).any(axis=1))
+    if len(non_ascii):
+        value = str(values[non_ascii[0]])
+        start = next(i for i, char in enumerate(value) if ord(char) > 127)
+        raise UnicodeEncodeError("ascii", value, start, start + 1, "ordinal not in range(128)")
+
+    buffer = values.astype(np.bytes_)
+    width = buffer.dtype.itemsize
+    lengths = np.char.str_len(buffer).astype(np.int64)
+    return buffer.view(np.uint8).reshape(len(buffer), width), lengths
+
+
+@njit(nogil=True)
+def _jw_scalar(s1, len1, s2, len2):
+    """
+    Jaro Winkler similarity between two encoded strings.
+    """
+    if len1 == 0 or len2 == 0:
+        return 0.0
+
+    search_range = max(len1, len2) // 2 - 1
+    if search_range < 0:
+        search_range = 0
+
+    # find the common characters within the matching window
+    flag1 = np.zeros(len1, np.bool_)
+    flag2 = np.zeros(len2, np.bool_)
+    common = 0
+    for i in range(len1):
+        low = max(0, i - search_range)
+        high = min(i + search_range + 1, len2)
+        for j in range(low, high):
+            if not flag2[j] and s2[j] == s1[i]:
+                flag1[i] = True
+                flag2[j] = True
+                common += 1
+                break
+
+    if common == 0:
+        return 0.0
+
+    # count the transpositions between common characters
+    k = 0
+    transpositions = 0
+    for i in range(len1):
+        if flag1[i]:
+            while not flag2[k]:
+                k += 1
+            if s1[i] != s2[k]:
+                transpositions += 1
+            k += 1
+    transpositions //= 2
+
+    weight = (common / len1 + common / len2 + (common - transpositions) / common) / 3
+
+    # bonus for the common prefix (up to 4 characters, digits excluded) 
+    # when both strings have more than 3 characters, as in jellyfish
+    if weight > 0.7 and len1 > 3 and len2 > 3:
+        prefix = 0
+        while prefix < 4 and s1[prefix] == s2[prefix] and not 48 <= s1[prefix] <= 57:
+            prefix += 1
+        weight += prefix * 0.1 * (1.0 - weight)
+
+    return weight
+
+
+@njit(nogil=True)
+def jw_batch(ref, ref_len, others, other_lens, out):
+    """
+    Compute the Jaro Winkler similarity between a reference string and each
+    row of an encoded array of strings. Results are written in out.
+    The GIL is released, so several clusters can be compared in threads.
+    """
+    for i in range(others.shape[0]):
+        out[i] = _jw_scalar(ref, ref_len, others[i], other_lens[i])